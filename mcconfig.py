@@ -1,31 +1,57 @@
 #!/usr/bin/python3
 
+import io
+import os
 import re
 import sys
+import shutil
+import json
+import hashlib
 import logging
 from typing import List, Iterable, Optional
 import argparse
 import itertools
-import subprocess
+import asyncio
+from asyncio.subprocess import DEVNULL, PIPE
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 from dataclasses import dataclass
-import multiprocessing as mp
+from datetime import date
+from pathlib import Path
 
 import yaml
 from lxml import etree
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
 
 RECPT1 = '/usr/local/bin/recpt1'
 EPGDUMP = '/usr/local/bin/epgdump'
 REC_TIME = 30
+EARLY_TIMEOUT = 8
+READ_SIZE = 65536
+
+NATSORT_RE = re.compile(r'(\d+)')
+CACHE_KEY_RE = re.compile(r'[^\w.-]')
+# epgdump output has no xml:id, DTD or meaningful whitespace; skip the bookkeeping for them
+XML_PARSER_OPTIONS = dict(huge_tree=True, collect_ids=False, no_network=True, remove_blank_text=True)
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+class NoAliasDumper(SafeDumper):
+    # channel dicts never share references, so skip the anchor/alias bookkeeping
+    def ignore_aliases(self, data):
+        return True
+
+
 @dataclass
 class ChannelTypeData:
     name: str
     channels: Iterable[int]
     epgdump_mode: Optional[str]
     recorder_ch_fmt: str
+    tuner: str  # bands with the same tuner type compete for the same tuners
 
 
 @dataclass
@@ -38,75 +64,180 @@ class GetEPGTask:
     recpt1: str
     epgdump: str
     seconds: int
+    early_timeout: int
+
+    cache_dir: Optional[Path]
     
         
-def get_epg_from_record(task: GetEPGTask):
-    logger.debug('EXEC: %s %s %d - | %s %s - -', task.recpt1, task.ch_to_rec, task.seconds, task.epgdump, task.epgdump_mode)
-    p_recpt1 = subprocess.Popen([task.recpt1, task.ch_to_rec, str(task.seconds), '-'],
-                                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-    p_epgdump = subprocess.Popen([task.epgdump, task.epgdump_mode, '-', '-'],
-                                 stdin=p_recpt1.stdout, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-    p_recpt1.stdout.close()
-
-    root = etree.parse(p_epgdump.stdout)
-    p_epgdump.wait()
-    return [xml_to_epg(task, channel) for channel in root.iter('channel')]
+async def get_epg_from_record(task: GetEPGTask):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('EXEC: %s %s %d - | %s %s - -', task.recpt1, task.ch_to_rec, task.seconds, task.epgdump, task.epgdump_mode)
+    # close_fds=False (all our fds are non-inheritable anyway) and absolute
+    # paths let subprocess use posix_spawn instead of fork+exec
+    p_recpt1 = await asyncio.create_subprocess_exec(task.recpt1, task.ch_to_rec, str(task.seconds), '-',
+                                                    stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL, close_fds=False)
+    p_epgdump = await asyncio.create_subprocess_exec(task.epgdump, task.epgdump_mode, '-', '-',
+                                                     stdin=PIPE, stdout=PIPE, stderr=DEVNULL, close_fds=False)
+
+    # not communicate(): since 3.12 it closes stdin, cutting epgdump off before the relay writes anything
+    skipped, xml = await asyncio.gather(relay_ts(task, p_recpt1, p_epgdump.stdin), p_epgdump.stdout.read())
+    await p_epgdump.wait()
+    await p_recpt1.wait()
+    return xml, p_recpt1.returncode == 0 and p_epgdump.returncode == 0, skipped
+
+async def relay_ts(task: GetEPGTask, p_recpt1, stdin) -> bool:
+    # a dead channel gives no TS at all; give up on it early instead of waiting out --seconds
+    skipped = False
+    try:
+        data = await asyncio.wait_for(p_recpt1.stdout.read(READ_SIZE), task.early_timeout or None)
+    except asyncio.TimeoutError:
+        logger.info('[%s] %s: no signal in %d seconds, skipping', task.chtype.name, task.ch_to_rec, task.early_timeout)
+        with suppress(ProcessLookupError):
+            p_recpt1.terminate()
+        data = b''
+        skipped = True
+
+    try:
+        while data:
+            stdin.write(data)
+            await stdin.drain()
+            data = await p_recpt1.stdout.read(READ_SIZE)
+    except (BrokenPipeError, ConnectionResetError):
+        with suppress(ProcessLookupError):
+            p_recpt1.terminate()
+    stdin.close()
+    return skipped
+
+def parse_epg(task: GetEPGTask, xml: bytes):
+    # stream <channel> elements and drop each one once consumed to keep memory flat
+    ctx = etree.iterparse(io.BytesIO(xml), events=('end',), tag='channel', **XML_PARSER_OPTIONS)
+    result = []
+    for _, channel in ctx:
+        ch = xml_to_epg(task, channel)
+        if ch is not None:
+            result.append(ch)
+        channel.clear()
+        while channel.getprevious() is not None:
+            del channel.getparent()[0]
+    del ctx
+    return result
 
 def xml_to_epg(task: GetEPGTask, channel):
-    ch_spec = { 'tp': channel.attrib['tp'] }
-    for item in channel.iterchildren():
-        ch_spec[item.tag] = item.text
+    sid = channel.findtext('service_id')
+    if not sid:
+        return None
 
     ch = {
         'type': task.chtype.name,
-        'name': ch_spec['display-name'],
-        'channel': ch_spec['tp'],
-        'serviceId': int(ch_spec['service_id']),
+        'name': channel.findtext('display-name') or None,
+        'channel': channel.get('tp'),
+        'serviceId': int(sid),
         'isDisabled': False
     }
-    if ch_spec['service_id'] is None:
-        del ch['serviceId']
     logger.info('[%s] %s: %s (sid %d)', ch['type'], ch['channel'], ch['name'], ch['serviceId'])
     return ch
 
-def get_epg_for_channel(chdef: GetEPGTask):
-    return get_epg_from_record(chdef)
+def default_cache_dir() -> Path:
+    return Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'mcconfig'
+
+def cache_path(task: GetEPGTask) -> Optional[Path]:
+    if task.cache_dir is None:
+        return None
+    # everything that can change the scan result goes into the key
+    spec = json.dumps([task.chtype.name, task.ch_to_rec, task.epgdump_mode, task.seconds, task.early_timeout,
+                       task.recpt1, task.epgdump])
+    key = CACHE_KEY_RE.sub('_', '{}_{}'.format(task.chtype.name, task.ch_to_rec))
+    return task.cache_dir / date.today().isoformat() / '{}_{}.json'.format(key, hashlib.sha1(spec.encode()).hexdigest()[:16])
+
+def load_cached_epg(task: GetEPGTask):
+    path = cache_path(task)
+    if path is None:
+        return None
+    try:
+        with path.open(encoding='utf-8') as f:
+            channels = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning('ignoring unreadable cache %s: %s', path, e)
+        return None
+    if not isinstance(channels, list) or not channels:
+        logger.warning('ignoring malformed cache %s', path)
+        return None
+    return channels
+
+def store_cached_epg(task: GetEPGTask, channels):
+    path = cache_path(task)
+    if path is None:
+        return
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix('.tmp')
+        with tmp.open('w', encoding='utf-8') as f:
+            json.dump(channels, f, ensure_ascii=False)
+        tmp.replace(path)
+    except OSError as e:
+        logger.warning('cannot write cache %s: %s', path, e)
+
+async def get_epg_for_channel(chdef: GetEPGTask, tuners: asyncio.Semaphore, parse_pool: ThreadPoolExecutor):
+    result = load_cached_epg(chdef)
+    if result is not None:
+        logger.info('[%s] %s: using today\'s cached scan', chdef.chtype.name, chdef.ch_to_rec)
+        return result
+
+    async with tuners:
+        xml, ok, skipped = await get_epg_from_record(chdef)
+    if not ok and not skipped:
+        logger.warning('[%s] %s: recpt1 or epgdump failed, channel may be missing', chdef.chtype.name, chdef.ch_to_rec)
+    # the tuner is free again here, so the next recording starts while this one is parsed
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(parse_pool, parse_epg, chdef, xml)
+    # only cache clean, non-empty scans so a retry after fixing the hardware really records again
+    if ok and result:
+        store_cached_epg(chdef, result)
+    return result
 
 def mix_args(chtype: ChannelTypeData, ch: int, args) -> GetEPGTask:
     return GetEPGTask(chtype, chtype.recorder_ch_fmt.format(name=chtype.name, ch=ch),
-                      chtype.epgdump_mode if chtype.epgdump_mode else str(ch), args.recpt1, args.epgdump, args.seconds)
+                      chtype.epgdump_mode if chtype.epgdump_mode else str(ch), args.recpt1, args.epgdump, args.seconds, args.early_timeout,
+                      args.cache_dir if args.cache else None)
 
 def natsort_for_channel(i):
-    def atoi(text):
-        return int(text) if text.isdigit() else text
-    def natural_keys(text):
-        return [atoi(c) for c in re.split(r'(\d+)', text)]
-    return natural_keys(i['channel'])
+    return [int(c) if c.isdigit() else c for c in NATSORT_RE.split(i['channel'])]
 
-def get_epg_for_chtype_mp(pool, chtype: ChannelTypeData, args):
+async def get_epg_for_chtype(chtype: ChannelTypeData, args, tuners: asyncio.Semaphore, parse_pool: ThreadPoolExecutor):
     channels: List[GetEPGTask] = [mix_args(chtype, ch, args) for ch in chtype.channels]
-    result = [
-        c for ch in pool.imap_unordered(get_epg_for_channel, channels, 4) if len(ch) > 0
-        for c in ch if ch
-    ]
+    results = await asyncio.gather(*[get_epg_for_channel(chdef, tuners, parse_pool) for chdef in channels])
+    result = list(itertools.chain.from_iterable(results))
     return remove_duplicate_service(chtype, result)
 
+async def get_epg_for_chtypes(chtypes: List[ChannelTypeData], args):
+    # bands on different tuner types record at once; BS and CS share the satellite tuners
+    tuners = {chtype.tuner: asyncio.Semaphore(args.tuners) for chtype in chtypes}
+    with ThreadPoolExecutor(max_workers=1) as parse_pool:
+        results = await asyncio.gather(*[get_epg_for_chtype(chtype, args, tuners[chtype.tuner], parse_pool)
+                                         for chtype in chtypes])
+    return list(itertools.chain.from_iterable(results))
+
 def remove_duplicate_service(chtype: ChannelTypeData, channels: List[GetEPGTask]):
     if chtype.name == 'GR':
         return sorted(channels, key=natsort_for_channel)
 
-    key_func = lambda i: i['serviceId']
-    data = sorted(channels, key=key_func)
-    def find_nonnull_ch(g):
-        gl = list(g)
-        l = [i for i in gl if i['name']]
-        if l:
-            return l[0]
-        else:
-            return gl[0]
-    result = [find_nonnull_ch(g) for k, g in itertools.groupby(data, key=key_func)]
+    # keep the first channel per service, preferring one that has a name
+    best = {}
+    for c in channels:
+        sid = c['serviceId']
+        cur = best.get(sid)
+        if cur is None or (not cur['name'] and c['name']):
+            best[sid] = c
+
+    return sorted(best.values(), key=lambda c: (natsort_for_channel(c), c['serviceId']))
 
-    return sorted(result, key=natsort_for_channel)
+def non_negative_int(text: str) -> int:
+    value = int(text)
+    if value < 0:
+        raise argparse.ArgumentTypeError('must be 0 or more: {}'.format(text))
+    return value
 
 
 if __name__ == '__main__':
@@ -115,24 +246,33 @@ if __name__ == '__main__':
     parser.add_argument('--bs', '-b', action='store_true', help='receive BS channels (BS1..23)')
     parser.add_argument('--cs', '-c', action='store_true', help='receive CS channels (ND2..24)')
     parser.add_argument('--seconds', '-s', type=int, default=REC_TIME, help='seconds to record (default: %(default)d)')
-    parser.add_argument('--tuners', '-t', type=int, default=4, help='# of tuners for each band (default: %(default)d)')
+    parser.add_argument('--early-timeout', '-e', type=non_negative_int, default=EARLY_TIMEOUT,
+                        help='skip a channel if recpt1 outputs nothing within this many seconds, 0 to disable (default: %(default)d)')
+    parser.add_argument('--tuners', '-t', type=int, default=4, help='# of tuners for each of terrestrial (GR) and satellite (BS/CS) (default: %(default)d)')
+    parser.add_argument('--cache', action='store_true',
+                        help="reuse today's per-channel scan results from --cache-dir instead of recording again")
+    parser.add_argument('--cache-dir', type=Path, help='where --cache keeps scan results (default: $XDG_CACHE_HOME/mcconfig or ~/.cache/mcconfig)')
     parser.add_argument('--recpt1', default=RECPT1, help='path to recpt1 (default: %(default)s)')
     parser.add_argument('--epgdump', default=EPGDUMP, help='path to epgdump (default: %(default)s)')
+    parser.add_argument('--verbose', '-v', action='store_true', help='log the commands being run')
     args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    args.recpt1 = shutil.which(args.recpt1) or args.recpt1
+    args.epgdump = shutil.which(args.epgdump) or args.epgdump
+    if args.cache and args.cache_dir is None:
+        args.cache_dir = default_cache_dir()
 
     chtypes: List[ChannelTypeData] = []
-    if args.gr: chtypes.append(ChannelTypeData('GR', range(13, 53), None, "{ch:d}"))
-    if args.bs: chtypes.append(ChannelTypeData('BS', [1], '/BS', "{name:s}{ch:d}_0"))
-    if args.cs: chtypes.append(ChannelTypeData('CS', [2], '/CS', "{name:s}{ch:d}"))
+    if args.gr: chtypes.append(ChannelTypeData('GR', range(13, 53), None, "{ch:d}", 'T'))
+    if args.bs: chtypes.append(ChannelTypeData('BS', [1], '/BS', "{name:s}{ch:d}_0", 'S'))
+    if args.cs: chtypes.append(ChannelTypeData('CS', [2], '/CS', "{name:s}{ch:d}", 'S'))
 
     if len(chtypes) == 0:
         print("Nothing to do", file=sys.stderr)
         parser.print_help()
         sys.exit(1)
 
-    with mp.Pool(processes=args.tuners) as pool:
-        all_definitions = [ch for chtype_result in
-                           [get_epg_for_chtype_mp(pool, chtype, args) for chtype in chtypes]
-                           for ch in chtype_result]
+    all_definitions = asyncio.run(get_epg_for_chtypes(chtypes, args))
 
-    yaml.safe_dump(all_definitions, stream=sys.stdout, encoding='utf-8', allow_unicode=True, default_flow_style=False)
+    yaml.dump(all_definitions, stream=sys.stdout, Dumper=NoAliasDumper,
+              encoding='utf-8', allow_unicode=True, default_flow_style=False)